@@ -22,190 +22,722 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import os
+import re
+import glob
+import gzip
 import time
+import hashlib
+import array
 import atexit
+import signal
+import threading
 import argparse
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
 from jtop import jtop, JtopException
-from prometheus_client.core import InfoMetricFamily, GaugeMetricFamily, REGISTRY, CounterMetricFamily
-from prometheus_client import start_http_server
+from prometheus_client.core import InfoMetricFamily, GaugeMetricFamily, REGISTRY, CounterMetricFamily, Metric, Sample
+from prometheus_client.utils import floatToGoString
 
+try:
+    # Optional, keeps scrape connections alive between requests
+    import waitress
+except ImportError:
+    waitress = None
 
-class CustomCollector(object):
-    def __init__(self):
+
+# (label, jtop sensor name) pairs exported by jetson_temperatures
+TEMP_KEYS = (
+    ('ao', 'AO'),
+    ('gpu', 'GPU'),
+    ('tdiode', 'Tdiode'),
+    ('aux', 'AUX'),
+    ('cpu', 'CPU'),
+    ('thermal', 'thermal'),
+    ('tboard', 'Tboard'),
+)
+
+# Labels of the exported power readings, the last one is the board total
+RAIL_LABELS = ('cpu', 'cv', 'tot')
+# Quantities jtop reports for every power rail
+RAIL_QUANTITIES = ('power', 'volt', 'curr')
+
+# Placeholder for sensors jtop does not report
+NO_SENSOR = {'temp': 0}
+
+# Seconds between reads of values that rarely change (board state, disk, uptime)
+SLOW_INTERVAL = 30
+
+# Seconds to wait before asking jtop again after it reported no fresh data
+RETRY_INTERVAL = 1
+
+# Snapshot entries as (key, metric groups that export it, jtop reader), a failed
+# read leaves only its entry out and is counted against those groups
+FAST_READINGS = (
+    ('gpu', ('gpu',), lambda jetson: jetson.gpu),
+    ('memory', ('ram', 'swap'), lambda jetson: jetson.memory),
+    ('fan', ('fan',), lambda jetson: jetson.fan),
+    ('power', ('power',), lambda jetson: jetson.power),
+)
+SLOW_READINGS = (
+    ('nvpmodel', ('board',), lambda jetson: jetson.nvpmodel.name),
+    ('uptime', ('board',), lambda jetson: jetson.uptime),
+    ('disk', ('disk',), lambda jetson: jetson.disk),
+)
+
+# Prometheus text exposition format written by TextWriter
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Upper bound on the number of formatted sample prefixes TextWriter keeps
+PREFIX_CACHE_SIZE = 4096
+# Seconds a rendered scrape is reused for while the snapshots stay the same
+RESPONSE_MAX_AGE = 5
+
+CPU_FREQ_PATH = '/sys/devices/system/cpu/cpu{}/cpufreq/scaling_cur_freq'
+THERMAL_ZONES_GLOB = '/sys/class/thermal/thermal_zone*'
+
+
+def open_sysfs(path):
+    """Open a sysfs file for repeated reads, None if it is not available"""
+    try:
+        return os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+
+
+def read_sysfs(fd):
+    """Read the integer value of an already open sysfs file, None if it cannot be read"""
+    if fd is None:
+        return None
+    try:
+        # int() parses the raw bytes in C, trailing newline included, so there is no
+        # decode or strip, and a hand written digit loop in Python would only be slower
+        return int(os.pread(fd, 32, 0))
+    except (OSError, ValueError):
+        # Power gated zones and offline cores fail their reads, jtop treats them as offline
+        return None
+
+
+def thermal_zones():
+    """Map thermal zone names, shortened the way jtop names its sensors, to their temp files"""
+    zones = {}
+    for zone in sorted(glob.glob(THERMAL_ZONES_GLOB)):
+        try:
+            with open(os.path.join(zone, 'type')) as f:
+                name = re.split('[-_]', f.read().strip())[0].lower()
+        except OSError:
+            continue
+        zones.setdefault(name, os.path.join(zone, 'temp'))
+    return zones
+
+
+def rail_readings(power):
+    """jtop power readings in RAIL_LABELS order"""
+    rails = power['rail']
+    return [rails['VDD_CPU_GPU_CV'], rails['VDD_SOC'], power['tot']]
+
+
+def enabled_readings(readings, groups):
+    """Snapshot readings exported by any of the groups, charging failures to those groups only"""
+    enabled = []
+    for key, exported_by, reader in readings:
+        exported_by = tuple(group for group in exported_by if group in groups)
+        if exported_by:
+            enabled.append((key, exported_by, reader))
+    return enabled
+
+
+def gauge_family(name, documentation, label, keys):
+    """Build a gauge family with one zero valued sample per label value"""
+    g = GaugeMetricFamily(name, documentation, labels=[label])
+    for key in keys:
+        g.add_metric([key], 0)
+    return g
+
+
+def set_values(family, values):
+    """Overwrite the sample values of a prebuilt family, in label order"""
+    family.samples = [sample._replace(value=float(value)) for sample, value in zip(family.samples, values)]
+
+
+class ArraySamples(object):
+    """Samples of a single label family, read from a value array when iterated"""
+
+    def __init__(self, name, label, keys, values):
+        self._name = name
+        self._labels = [{label: key} for key in keys]
+        self._values = values
+
+    def __iter__(self):
+        for labels, value in zip(self._labels, self._values):
+            yield Sample(self._name, labels, value)
+
+
+class JetsonStats(object):
+    """Owns the jtop connection and publishes its latest readings as a snapshot"""
+
+    def __init__(self, groups):
+        # Everything cleanup() touches exists before it can run
+        self._jetson = None
+        self._slow_timer = None
+        self._cpu_fds = []
+        self._temp_fds = []
         atexit.register(self.cleanup)
         self._jetson = jtop()
         self._jetson.start()
 
+        # Static for the lifetime of the process
+        self.board = self._jetson.board
+        self.cpu_count = len(self._jetson.cpu['cpu'])
+
+        # Updated in place by the poller, sized once so they never reallocate
+        self.cpu_freqs = array.array('d', [0.0] * self.cpu_count)
+        self.temperatures = array.array('d', [0.0] * len(TEMP_KEYS))
+
+        #
+        # CPU frequencies and temperatures are read straight from sysfs where
+        # possible, anything missing falls back to the jtop readings.
+        # Sources of disabled metric groups are never opened or read.
+        #
+        if 'cpu' in groups:
+            self._cpu_fds = [open_sysfs(CPU_FREQ_PATH.format(i)) for i in range(self.cpu_count)]
+        if 'temperature' in groups:
+            zones = thermal_zones()
+            self._temp_fds = [open_sysfs(zones[key.lower()]) if key.lower() in zones else None for _, key in TEMP_KEYS]
+        self._fast_readings = enabled_readings(FAST_READINGS, groups)
+        self._slow_readings = enabled_readings(SLOW_READINGS, groups)
+
+        #
+        # Poll jtop in the background so scrapes only read the latest snapshots,
+        # fast changing readings on every jtop update and the rest every SLOW_INTERVAL
+        #
+        self.snapshot = None
+        self.slow_snapshot = None
+        self.last_update = None
+        # Bumped on every published snapshot, each by the only thread writing it
+        self.fast_version = 0
+        self.slow_version = 0
+        # Failed reads or collects per metric group, every group exported from zero
+        # so the first failure shows up in increase() and rate()
+        self.errors = dict.fromkeys(list(groups) + ['jtop'], 0)
+        self._errors_lock = threading.Lock()
+        self._slow_poll()
+        self._poller = threading.Thread(target=self._poll_loop, daemon=True)
+        self._poller.start()
+
     def cleanup(self):
         print("Closing jetson-stats connection...")
-        self._jetson.close()
+        if self._slow_timer is not None:
+            self._slow_timer.cancel()
+        if self._jetson is not None:
+            self._jetson.close()
+        for fd in self._cpu_fds + self._temp_fds:
+            if fd is not None:
+                os.close(fd)
+
+    def record_error(self, group):
+        with self._errors_lock:
+            self.errors[group] = self.errors.get(group, 0) + 1
+
+    def error_counts(self):
+        with self._errors_lock:
+            return sorted(self.errors.items())
+
+    def _poll_loop(self):
+        # jtop.ok() blocks until jtop has fresh data, so this runs once per jtop update.
+        # A timeout or a failing jtop must not end the loop, the snapshots would freeze.
+        while True:
+            try:
+                ok = self._jetson.ok()
+            except Exception:
+                self.record_error('jtop')
+                ok = False
+            if ok:
+                self._poll()
+            else:
+                time.sleep(RETRY_INTERVAL)
+
+    def _read(self, readings):
+        """Build a snapshot from the readings that succeed"""
+        snap = {}
+        for key, groups, reader in readings:
+            try:
+                snap[key] = reader(self._jetson)
+            except Exception:
+                for group in groups:
+                    self.record_error(group)
+        return snap
+
+    def _read_cpu_freqs(self):
+        for i, fd in enumerate(self._cpu_fds):
+            freq = read_sysfs(fd)
+            if freq is not None:
+                self.cpu_freqs[i] = freq
+                continue
+            try:
+                self.cpu_freqs[i] = self._jetson.cpu['cpu'][i]['freq']['cur']
+            except Exception:
+                # Keeps the previous value for this core only
+                self.record_error('cpu')
+
+    def _read_temperatures(self):
+        for i, fd in enumerate(self._temp_fds):
+            temp = read_sysfs(fd)
+            if temp is not None:
+                # Thermal zones report millidegrees Celsius
+                self.temperatures[i] = temp / 1000.0
+                continue
+            try:
+                self.temperatures[i] = self._jetson.temperature.get(TEMP_KEYS[i][1], NO_SENSOR)['temp']
+            except Exception:
+                # Keeps the previous value for this sensor only
+                self.record_error('temperature')
+
+    def _poll(self):
+        self._read_cpu_freqs()
+        self._read_temperatures()
+        self.snapshot = self._read(self._fast_readings)
+        self.last_update = time.monotonic()
+        self.fast_version += 1
+
+    def _slow_poll(self):
+        self.slow_snapshot = self._read(self._slow_readings)
+        self.slow_version += 1
+        self._slow_timer = threading.Timer(SLOW_INTERVAL, self._slow_poll)
+        self._slow_timer.daemon = True
+        self._slow_timer.start()
+
+
+class SnapshotCollector(object):
+    """Exports one group of readings from the snapshot shared through JetsonStats"""
+
+    # Name of the metric group, used by --disable and jetson_collector_errors
+    group = None
+    # Read from the slow snapshot instead of the per jtop update one
+    slow = False
+    # Snapshot entries the group exports, a failed read was already counted by the poller
+    keys = ()
+
+    def __init__(self, stats):
+        self._stats = stats
+
+    def collect(self):
+        snap = self._stats.slow_snapshot if self.slow else self._stats.snapshot
+        if snap is not None and all(key in snap for key in self.keys):
+            # A reading missing on this board drops only this group from the scrape
+            try:
+                metrics = list(self._collect(snap))
+            except Exception:
+                self._stats.record_error(self.group)
+                return
+            yield from metrics
+
+    def _collect(self, snap):
+        raise NotImplementedError
+
+
+class BoardInfoCollector(SnapshotCollector):
+    group = 'board'
+    slow = True
+
+    def __init__(self, stats):
+        super().__init__(stats)
+        #
+        # Board info does not change while running, build it once
+        #
+        board = stats.board
+        board_info = InfoMetricFamily('jetson_info_board', 'Board sys info', labels=['board_info'])
+        board_info.add_metric(['info'], {
+            'machine': board['platform']['Machine'],
+            'distribution': board['platform']['Distribution'],
+            'release': board['platform']['Release'],
+            'jetpack': board['hardware']['Jetpack'],
+            'l4t': board['hardware']['L4T'],
+            'module': board['hardware']['Module'],
+            'type': board['hardware']['Model'],
+            'codename': board['hardware']['Codename'],
+            'soc': board['hardware']['SoC'],
+            'cuda_arch_bin': board['hardware']['CUDA Arch BIN'],
+            'serial_number': board['hardware']['Serial Number']
+            })
+        # Eleven label strings that never change, send the same bytes on every scrape
+        self._board_info = RenderedMetric(board_info)
+
+        self._nvpmode = InfoMetricFamily('jetson_nvpmode', 'NV power mode', labels=['nvpmode'])
+        self._mode = None
+        self._uptime = gauge_family('jetson_uptime', 'System uptime', 'uptime', ['days', 'hours', 'minutes'])
+
+    def _collect(self, snap):
+        #
+        # Board info 
+        #
+        yield self._board_info
+
+        #
+        # NV power mode
+        #
+        # The labels carry the mode name, rebuild only when it changes
+        if 'nvpmodel' in snap:
+            if snap['nvpmodel'] != self._mode:
+                self._mode = snap['nvpmodel']
+                self._nvpmode.samples = []
+                self._nvpmode.add_metric(['mode'], {'mode': self._mode})
+            yield self._nvpmode
+
+        #
+        # System uptime 
+        #
+        if 'uptime' in snap:
+            uptime = snap['uptime']
+            hours, seconds = divmod(uptime.seconds, 3600)
+            set_values(self._uptime, [uptime.days, hours, seconds // 60])
+            yield self._uptime
+
+
+class CpuCollector(SnapshotCollector):
+    group = 'cpu'
+
+    def __init__(self, stats):
+        super().__init__(stats)
+        # One label per core, the core count depends on the board
+        cpu_labels = ['cpu_{}'.format(i) for i in range(1, stats.cpu_count + 1)]
+        self._cpu = Metric('jetson_usage_cpu', 'CPU % schedutil', 'gauge')
+        self._cpu.samples = ArraySamples('jetson_usage_cpu', 'cpu', cpu_labels, stats.cpu_freqs)
+
+    def _collect(self, snap):
+        yield self._cpu
+
+
+class GpuCollector(SnapshotCollector):
+    group = 'gpu'
+    keys = ('gpu',)
+
+    def __init__(self, stats):
+        super().__init__(stats)
+        self._gpu = gauge_family('jetson_usage_gpu', 'GPU % schedutil', 'gpu', ['val'])
+
+    def _collect(self, snap):
+        set_values(self._gpu, [snap['gpu']['ga10b']['status']['load']])
+        yield self._gpu
+
+
+class RamCollector(SnapshotCollector):
+    group = 'ram'
+    keys = ('memory',)
+
+    def __init__(self, stats):
+        super().__init__(stats)
+        self._ram = gauge_family('jetson_usage_ram', 'Memory usage', 'ram', ['used', 'shared', 'total'])
+
+    def _collect(self, snap):
+        ram = snap['memory']['RAM']
+        set_values(self._ram, [ram['used'], ram['shared'], ram['tot']])
+        yield self._ram
+
+
+class DiskCollector(SnapshotCollector):
+    group = 'disk'
+    slow = True
+    keys = ('disk',)
+
+    def __init__(self, stats):
+        super().__init__(stats)
+        self._disk = gauge_family('jetson_usage_disk', 'Disk space usage', 'disk', ['used', 'total', 'available', 'available_no_root'])
+
+    def _collect(self, snap):
+        disk = snap['disk']
+        set_values(self._disk, [disk['used'], disk['total'], disk['available'], disk['available_no_root']])
+        yield self._disk
+
+
+class FanCollector(SnapshotCollector):
+    group = 'fan'
+    keys = ('fan',)
+
+    def __init__(self, stats):
+        super().__init__(stats)
+        self._fan = gauge_family('jetson_usage_fan', 'Fan usage', 'fan', ['speed', 'rpm'])
+
+    def _collect(self, snap):
+        fan = snap['fan']['pwmfan']
+        set_values(self._fan, [fan['speed'][0], fan['rpm'][0]])
+        yield self._fan
+
+
+class SwapCollector(SnapshotCollector):
+    group = 'swap'
+    keys = ('memory',)
+
+    def __init__(self, stats):
+        super().__init__(stats)
+        self._swap = gauge_family('jetson_usage_swap', 'Swapfile usage', 'swap', ['used', 'total'])
+
+    def _collect(self, snap):
+        swap = snap['memory']['SWAP']
+        set_values(self._swap, [swap['used'], swap['tot']])
+        yield self._swap
+
+
+class TemperatureCollector(SnapshotCollector):
+    group = 'temperature'
+
+    def __init__(self, stats):
+        super().__init__(stats)
+        self._temperatures = Metric('jetson_temperatures', 'Sensor temperatures', 'gauge')
+        self._temperatures.samples = ArraySamples('jetson_temperatures', 'temperature',
+                                                  [label for label, _ in TEMP_KEYS], stats.temperatures)
+
+    def _collect(self, snap):
+        yield self._temperatures
+
+
+class PowerCollector(SnapshotCollector):
+    group = 'power'
+    keys = ('power',)
+
+    def __init__(self, stats):
+        super().__init__(stats)
+        # Power, voltage and current of every rail in a single family
+        self._rails = GaugeMetricFamily('jetson_rail_measurement', 'Power rail readings', labels=['rail', 'quantity'])
+        for rail in RAIL_LABELS:
+            for quantity in RAIL_QUANTITIES:
+                self._rails.add_metric([rail, quantity], 0)
+
+    def _collect(self, snap):
+        readings = rail_readings(snap['power'])
+        set_values(self._rails, [reading[quantity] for reading in readings for quantity in RAIL_QUANTITIES])
+        yield self._rails
+
+
+class LegacyPowerCollector(SnapshotCollector):
+    group = 'power'
+    keys = ('power',)
+
+    def __init__(self, stats):
+        super().__init__(stats)
+        self._power = gauge_family('jetson_usage_power', 'Power usage', 'power', RAIL_LABELS)
+
+    def _collect(self, snap):
+        set_values(self._power, [reading['power'] for reading in rail_readings(snap['power'])])
+        yield self._power
+
+
+class StatusCollector(object):
+    """Health of the collector itself, exported whatever the state of the snapshots"""
+
+    def __init__(self, stats):
+        self._stats = stats
+        self._age = GaugeMetricFamily('jetson_last_update_age_seconds', 'Age of last jtop snapshot')
+        self._age.add_metric([], 0)
 
     def collect(self):
-        if self._jetson.ok():
-            # print('emc: ', self._jetson.emc)
-            # print('iram: ', self._jetson.iram)
-            # print('mts: ', self._jetson.mts)
-
-            #
-            # Board info 
-            #
-            i = InfoMetricFamily('jetson_info_board', 'Board sys info', labels=['board_info'])
-            i.add_metric(['info'], {
-                'machine': self._jetson.board['platform']['Machine'],
-                'distribution': self._jetson.board['platform']['Distribution'],
-                'release': self._jetson.board['platform']['Release'],
-                'jetpack': self._jetson.board['hardware']['Jetpack'], 
-                'l4t': self._jetson.board['hardware']['L4T'],
-                'module': self._jetson.board['hardware']['Module'],
-                'type': self._jetson.board['hardware']['Model'],
-                'codename': self._jetson.board['hardware']['Codename'],
-                'soc': self._jetson.board['hardware']['SoC'],
-                'cuda_arch_bin': self._jetson.board['hardware']['CUDA Arch BIN'],
-                'serial_number': self._jetson.board['hardware']['Serial Number']
-                })
-            yield i
-
-            #
-            # NV power mode
-            #
-            i = InfoMetricFamily('jetson_nvpmode', 'NV power mode', labels=['nvpmode'])
-            i.add_metric(['mode'], {'mode': self._jetson.nvpmodel.name})
-            yield i
-
-            #
-            # System uptime 
-            #
-            g = GaugeMetricFamily('jetson_uptime', 'System uptime', labels=['uptime'])
-            days = self._jetson.uptime.days
-            seconds = self._jetson.uptime.seconds
-            hours = seconds//3600
-            minutes = (seconds//60) % 60
-            g.add_metric(['days'], days)
-            g.add_metric(['hours'], hours)
-            g.add_metric(['minutes'], minutes)
-            yield g
-
-            #
-            # CPU usage 
-            #
-            g = GaugeMetricFamily('jetson_usage_cpu', 'CPU % schedutil', labels=['cpu'])
-            g.add_metric(['cpu_1'], self._jetson.cpu['cpu'][0]['freq']['cur'])
-            g.add_metric(['cpu_2'], self._jetson.cpu['cpu'][1]['freq']['cur'])
-            g.add_metric(['cpu_3'], self._jetson.cpu['cpu'][2]['freq']['cur'])
-            g.add_metric(['cpu_4'], self._jetson.cpu['cpu'][3]['freq']['cur'])
-            g.add_metric(['cpu_5'], self._jetson.cpu['cpu'][4]['freq']['cur'])
-            g.add_metric(['cpu_6'], self._jetson.cpu['cpu'][5]['freq']['cur'])
-            g.add_metric(['cpu_7'], self._jetson.cpu['cpu'][6]['freq']['cur'])
-            g.add_metric(['cpu_8'], self._jetson.cpu['cpu'][7]['freq']['cur'])
-            yield g
-
-            # 
-            # GPU usage
-            #
-            g = GaugeMetricFamily('jetson_usage_gpu', 'GPU % schedutil', labels=['gpu'])
-            g.add_metric(['val'], self._jetson.gpu['ga10b']['status']['load'])
-            # g.add_metric(['frq'], self._jetson.gpu['frq'])
-            # g.add_metric(['min_freq'], self._jetson.gpu['min_freq'])
-            # g.add_metric(['max_freq'], self._jetson.gpu['max_freq'])
-            yield g
-
-            # 
-            # RAM usage
-            #
-            g = GaugeMetricFamily('jetson_usage_ram', 'Memory usage', labels=['ram'])
-            g.add_metric(['used'], self._jetson.memory['RAM']['used'])
-            g.add_metric(['shared'], self._jetson.memory['RAM']['shared'])
-            g.add_metric(['total'], self._jetson.memory['RAM']['tot'])
-            # g.add_metric(['unit'], self._jetson.ram['unit'])
-            yield g
-
-            # 
-            # Disk usage
-            #
-            g = GaugeMetricFamily('jetson_usage_disk', 'Disk space usage', labels=['disk'])
-            g.add_metric(['used'], self._jetson.disk['used'])
-            g.add_metric(['total'], self._jetson.disk['total'])
-            g.add_metric(['available'], self._jetson.disk['available'])
-            g.add_metric(['available_no_root'], self._jetson.disk['available_no_root'])
-            yield g
-
-            # 
-            # Fan usage
-            #
-            g = GaugeMetricFamily('jetson_usage_fan', 'Fan usage', labels=['fan'])
-            g.add_metric(['speed'], self._jetson.fan['pwmfan']['speed'][0])
-            g.add_metric(['rpm'], self._jetson.fan['pwmfan']['rpm'][0])
-            # g.add_metric(['measure'], self._jetson.fan['measure'])
-            # g.add_metric(['auto'], self._jetson.fan['auto'])
-            # g.add_metric(['rpm'], self._jetson.fan['rpm'])
-            # g.add_metric(['mode'], self._jetson.fan['mode'])
-            yield g
-
-            # 
-            # Swapfile usage
-            #
-            g = GaugeMetricFamily('jetson_usage_swap', 'Swapfile usage', labels=['swap'])
-            g.add_metric(['used'], self._jetson.memory['SWAP']['used'])
-            g.add_metric(['total'], self._jetson.memory['SWAP']['tot'])
-            # g.add_metric(['unit'], self._jetson.swap['unit'])
-            # g.add_metric(['cached_size'], self._jetson.swap['cached']['size'])
-            # g.add_metric(['cached_unit'], self._jetson.swap['cached']['unit'])
-            yield g
-
-            # 
-            # Sensor temperatures
-            #
-            g = GaugeMetricFamily('jetson_temperatures', 'Sensor temperatures', labels=['temperature'])
-            g.add_metric(['ao'], self._jetson.temperature['AO']["temp"] if 'AO' in self._jetson.temperature else 0)
-            g.add_metric(['gpu'], self._jetson.temperature['GPU']["temp"] if 'GPU' in self._jetson.temperature else 0)
-            g.add_metric(['tdiode'], self._jetson.temperature['Tdiode']["temp"] if 'Tdiode' in self._jetson.temperature else 0)
-            g.add_metric(['aux'], self._jetson.temperature['AUX']["temp"] if 'AUX' in self._jetson.temperature else 0)
-            g.add_metric(['cpu'], self._jetson.temperature['CPU']["temp"] if 'CPU' in self._jetson.temperature else 0)
-            g.add_metric(['thermal'], self._jetson.temperature['thermal']["temp"] if 'thermal' in self._jetson.temperature else 0)
-            g.add_metric(['tboard'], self._jetson.temperature['Tboard']["temp"] if 'Tboard' in self._jetson.temperature else 0)
-            yield g
-
-            # 
-            # Power
-            #
-            g = GaugeMetricFamily('jetson_usage_power', 'Power usage', labels=['power'])
-            g.add_metric(['cpu'], self._jetson.power['rail']['VDD_CPU_GPU_CV']['power'] )
-            g.add_metric(['cv'], self._jetson.power['rail']['VDD_SOC']['power'] )
-            g.add_metric(['tot'], self._jetson.power['tot']['power'] )
-            #g.add_metric(['gpu'], self._jetson.power['rail']['GPU']['power'] ) 
-            #g.add_metric(['soc'], self._jetson.power['rail']['SOC']['power'] )
-            #g.add_metric(['sys5v'], self._jetson.power['rail']['SYS5V']['power'] )
-            #g.add_metric(['vddrq'], self._jetson.power['rail']['VDDRQ']['power'] )
-            yield g
-
-            g = GaugeMetricFamily('jetson_usage_voltage_levels', 'Voltage', labels=['voltage'])
-            g.add_metric(['cpu'], self._jetson.power['rail']['VDD_CPU_GPU_CV']['volt'] ) 
-            g.add_metric(['cv'], self._jetson.power['rail']['VDD_SOC']['volt'] )
-            g.add_metric(['tot'], self._jetson.power['tot']['volt'] )
-            #g.add_metric(['gpu'], self._jetson.power['rail']['GPU']['volt'] ) 
-            #g.add_metric(['soc'], self._jetson.power['rail']['SOC']['volt'] )
-            #g.add_metric(['sys5v'], self._jetson.power['rail']['SYS5V']['volt'] )
-            #g.add_metric(['vddrq'], self._jetson.power['rail']['VDDRQ']['volt'] )
-            #yield g
-
-            g = GaugeMetricFamily('jetson_usage_current_values', 'Current', labels=['current'])
-            g.add_metric(['cpu'], self._jetson.power['rail']['VDD_CPU_GPU_CV']['curr'] )
-            g.add_metric(['cv'], self._jetson.power['rail']['VDD_SOC']['curr'] )
-            g.add_metric(['tot'], self._jetson.power['tot']['curr'] )
-            #g.add_metric(['gpu'], self._jetson.power['rail']['GPU']['curr'] ) 
-            #g.add_metric(['soc'], self._jetson.power['rail']['SOC']['curr'] )
-            #g.add_metric(['sys5v'], self._jetson.power['rail']['SYS5V']['curr'] )
-            #g.add_metric(['vddrq'], self._jetson.power['rail']['VDDRQ']['curr'] )
-            #yield g
+        last_update = self._stats.last_update
+        if last_update is not None:
+            # Keeps growing if jtop stops updating, so stale data can be alerted on
+            set_values(self._age, [time.monotonic() - last_update])
+            yield self._age
+
+        errors = CounterMetricFamily('jetson_collector_errors', 'Failed reads or collects per metric group', labels=['group'])
+        for group, count in self._stats.error_counts():
+            errors.add_metric([group], count)
+        yield errors
+
+
+# Registered independently so a failing or slow group does not hold up the others
+COLLECTORS = {collector.group: collector for collector in (
+    BoardInfoCollector,
+    CpuCollector,
+    GpuCollector,
+    RamCollector,
+    DiskCollector,
+    FanCollector,
+    SwapCollector,
+    TemperatureCollector,
+    PowerCollector,
+)}
+
+
+def escape_label(value):
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+class TextWriter(object):
+    """Renders a registry in the Prometheus text format
+
+    The metric families are long lived and keep their label dicts between
+    scrapes, so the HELP/TYPE header of every family and the name{labels}
+    prefix of every sample are formatted once and reused, leaving only the
+    values to format on each scrape.
+    """
+
+    def __init__(self, registry):
+        self._registry = registry
+        self._headers = {}
+        self._prefixes = {}
+
+    def generate(self):
+        output = bytearray()
+        for metric in self._registry.collect():
+            rendered = getattr(metric, 'rendered', None)
+            if rendered is not None:
+                output += rendered
+                continue
+            header = self._headers.get(metric.name)
+            if header is None:
+                header = self._headers[metric.name] = self._header(metric)
+            output += header
+            for sample in metric.samples:
+                # Keyed on the label dict object, an id reused by another dict is caught by the
+                # content check. Families rebuilt on every collect (gc, process) keep adding
+                # entries, so the cache is dropped once it grows past PREFIX_CACHE_SIZE.
+                key = (sample.name, id(sample.labels))
+                entry = self._prefixes.get(key)
+                if entry is None or entry[0] != sample.labels:
+                    if len(self._prefixes) >= PREFIX_CACHE_SIZE:
+                        self._prefixes.clear()
+                    entry = self._prefixes[key] = (dict(sample.labels), self._prefix(sample))
+                output += entry[1]
+                output += floatToGoString(sample.value).encode()
+                output += b'\n'
+        return bytes(output)
+
+    @classmethod
+    def render(cls, metric):
+        """Format a whole family, without going through the caches"""
+        lines = [cls._header(metric)]
+        for sample in metric.samples:
+            lines.append(cls._prefix(sample) + floatToGoString(sample.value).encode() + b'\n')
+        return b''.join(lines)
+
+    @staticmethod
+    def _header(metric):
+        name, mtype = metric.name, metric.type
+        if mtype == 'counter':
+            name += '_total'
+        elif mtype == 'info':
+            name += '_info'
+            mtype = 'gauge'
+        elif mtype == 'unknown':
+            mtype = 'untyped'
+        documentation = metric.documentation.replace('\\', r'\\').replace('\n', r'\n')
+        return '# HELP {0} {1}\n# TYPE {0} {2}\n'.format(name, documentation, mtype).encode()
+
+    @staticmethod
+    def _prefix(sample):
+        if not sample.labels:
+            return '{} '.format(sample.name).encode()
+        labels = ','.join('{}="{}"'.format(k, escape_label(v)) for k, v in sorted(sample.labels.items()))
+        return '{}{{{}}} '.format(sample.name, labels).encode()
+
+
+class RenderedMetric(Metric):
+    """Family whose values never change, formatted once and written out as is by TextWriter"""
+
+    def __init__(self, metric):
+        super().__init__(metric.name, metric.documentation, metric.type)
+        # Kept so other prometheus_client writers still see the samples
+        self.samples = metric.samples
+        self.rendered = TextWriter.render(metric)
+
+
+class MetricsApp(object):
+    """WSGI application serving the registry, gzip compressed when the scraper accepts it
+
+    Scrapes landing while the jtop snapshots are unchanged, e.g. from several
+    Prometheus replicas, get the same rendered response, and a matching
+    If-None-Match is answered with 304 Not Modified. A response is reused for
+    at most RESPONSE_MAX_AGE seconds so jetson_last_update_age_seconds keeps
+    moving when jtop stops updating.
+    """
+
+    def __init__(self, registry, stats):
+        self._writer = TextWriter(registry)
+        self._stats = stats
+        self._lock = threading.Lock()
+        # (snapshot versions, render time, body hash, output, gzipped output) of the last scrape
+        self._last = None
+
+    def _render(self, compress):
+        version = (self._stats.fast_version, self._stats.slow_version)
+        with self._lock:
+            now = time.monotonic()
+            last = self._last
+            if last is None or last[0] != version or now - last[1] > RESPONSE_MAX_AGE:
+                output = self._writer.generate()
+                # Derived from the body so it stays valid across restarts
+                etag = hashlib.blake2b(output, digest_size=8).hexdigest()
+                last = self._last = (version, now, etag, output, None)
+            if compress and last[4] is None:
+                # The text format is very repetitive, the fastest level already shrinks it several times
+                last = self._last = last[:4] + (gzip.compress(last[3], compresslevel=1),)
+            # Each encoding is a different body, so it gets its own tag
+            if compress:
+                return 'W/"{}-gz"'.format(last[2]), last[4]
+            return 'W/"{}"'.format(last[2]), last[3]
+
+    def __call__(self, environ, start_response):
+        compress = 'gzip' in environ.get('HTTP_ACCEPT_ENCODING', '')
+        etag, output = self._render(compress)
+        # The body depends on Accept-Encoding, caches in between must key on it
+        headers = [('ETag', etag), ('Cache-Control', 'no-cache'), ('Vary', 'Accept-Encoding')]
+        if environ.get('HTTP_IF_NONE_MATCH') == etag:
+            start_response('304 Not Modified', headers)
+            return [b'']
+        headers.append(('Content-Type', CONTENT_TYPE))
+        if compress:
+            headers.append(('Content-Encoding', 'gzip'))
+        headers.append(('Content-Length', str(len(output))))
+        start_response('200 OK', headers)
+        return [output]
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        # Do not log every scrape
+        pass
+
+
+def start_metrics_server(port, registry, stats):
+    """Serve the registry on the given port from a background thread
+
+    Uses waitress when it is installed, for HTTP keep-alive, and falls back
+    to the standard library wsgiref server otherwise.
+    """
+    app = MetricsApp(registry, stats)
+    if waitress is not None:
+        server = waitress.create_server(app, port=port, threads=4)
+        target = server.run
+    else:
+        server = make_server('', port, app, ThreadingWSGIServer, handler_class=QuietRequestHandler)
+        target = server.serve_forever
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    return server
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--port', type=int, default=8000, help='Metrics collector port number')
+    parser.add_argument('--legacy-power', action='store_true',
+                        help='Also export power as jetson_usage_power, as used by older dashboards')
+    parser.add_argument('--disable', nargs='*', default=[], choices=list(COLLECTORS), metavar='GROUP',
+                        help='Metric groups not to export, any of: {}'.format(', '.join(COLLECTORS)))
 
     args = parser.parse_args()
 
-    start_http_server(args.port)
-    REGISTRY.register(CustomCollector())
-    while True:
-        time.sleep(1)
+    groups = [group for group in COLLECTORS if group not in args.disable]
+    stats = JetsonStats(groups)
+    REGISTRY.register(StatusCollector(stats))
+    for group in groups:
+        REGISTRY.register(COLLECTORS[group](stats))
+    if args.legacy_power and 'power' in groups:
+        REGISTRY.register(LegacyPowerCollector(stats))
+    start_metrics_server(args.port, REGISTRY, stats)
+
+    # Sleep until stopped, SIGTERM returns normally so the atexit cleanup runs
+    shutdown = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: shutdown.set())
+    shutdown.wait()